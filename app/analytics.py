@@ -1,17 +1,47 @@
 from user_agents import parse
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
+from functools import lru_cache
+from urllib.parse import urlencode
+import ipaddress
+import logging
+import orjson
 import geoip2.database
 import geoip2.errors
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+
+def _open_geoip_reader() -> Optional[geoip2.database.Reader]:
+    """Open the GeoIP database once; the mmap'd reader is safe to share across requests."""
+    if not settings.geoip_db_path:
+        return None
+    try:
+        return geoip2.database.Reader(settings.geoip_db_path, mode=geoip2.database.MODE_MMAP)
+    except FileNotFoundError:
+        logger.warning("GeoIP database not found at %s; location lookups disabled", settings.geoip_db_path)
+        return None
+
+
+_geoip_reader = _open_geoip_reader()
+
 
 def detect_platform_and_device(user_agent_string: str) -> Tuple[str, str, str, str]:
     """
     Detect platform, device type, browser, and OS from user agent.
     Returns: (platform, device_type, browser, os)
     """
+    # Only the first 500 characters are stored, so they are all the cache key needs
+    return _detect_cached(user_agent_string[:500])
+
+
+@lru_cache(maxsize=32768)
+def _detect_cached(user_agent_string: str) -> Tuple[str, str, str, str]:
+    # Real traffic is dominated by a small set of user agents, so the regex
+    # walk in parse() is done once per distinct string.
     user_agent = parse(user_agent_string)
-    
+    is_mobile = user_agent.is_mobile
+
     # Determine platform
     # Native app requests use CFNetwork/Darwin (iOS) or okhttp (Android)
     # and won't contain typical browser user-agent tokens
@@ -19,7 +49,7 @@ def detect_platform_and_device(user_agent_string: str) -> Tuple[str, str, str, s
         platform = 'iOS'
     elif 'okhttp' in user_agent_string:
         platform = 'Android'
-    elif user_agent.is_mobile:
+    elif is_mobile:
         if 'iPhone' in user_agent_string or 'iPad' in user_agent_string:
             platform = 'iOS'
         elif 'Android' in user_agent_string:
@@ -28,80 +58,115 @@ def detect_platform_and_device(user_agent_string: str) -> Tuple[str, str, str, s
             platform = 'Mobile'
     else:
         platform = 'Desktop'
-    
+
     # Determine device type
-    if user_agent.is_mobile:
+    if is_mobile:
         device_type = 'Mobile'
     elif user_agent.is_tablet:
         device_type = 'Tablet'
     else:
         device_type = 'Desktop'
-    
+
     # Get browser and OS
     browser = f"{user_agent.browser.family} {user_agent.browser.version_string}"
     os = f"{user_agent.os.family} {user_agent.os.version_string}"
-    
+
     return platform, device_type, browser, os
 
 
+@lru_cache(maxsize=32768)
 def get_location_from_ip(ip_address: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """
     Get country, region, and city from IP address using GeoIP2.
+    Results are cached per IP, since the reader is fixed for the life of the process.
     Returns: (country_code, region, city)
     """
-    if not settings.geoip_db_path:
+    if _geoip_reader is None:
         return None, None, None
-    
+
     try:
-        with geoip2.database.Reader(settings.geoip_db_path) as reader:
-            response = reader.city(ip_address)
-            country = response.country.iso_code
-            region = response.subdivisions.most_specific.name
-            city = response.city.name
-            return country, region, city
-    except (geoip2.errors.AddressNotFoundError, FileNotFoundError, Exception):
+        response = _geoip_reader.city(ip_address)
+    except (geoip2.errors.AddressNotFoundError, ValueError):
         return None, None, None
 
+    return response.country.iso_code, response.subdivisions.most_specific.name, response.city.name
+
+
+def close_geoip_reader() -> None:
+    """Release the shared GeoIP reader on shutdown."""
+    if _geoip_reader is not None:
+        _geoip_reader.close()
+
+
+def _normalize_ip(value: Optional[str]) -> Optional[str]:
+    """Canonical form of an IP address, or None if the value isn't one."""
+    if not value:
+        return None
+    value = value.strip()
+    # The longest textual IPv6 address is 45 characters; skip parsing anything longer
+    if len(value) > 45:
+        return None
+    try:
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        return None
+
 
 def get_client_ip(request) -> str:
-    """Extract client IP address from request headers."""
+    """
+    Extract client IP address from request headers.
+    Header values are client-controlled, so only well-formed addresses are
+    accepted; they key the per-IP caches behind hashing and GeoIP.
+    """
+    headers = request.headers
+
     # Check for forwarded headers (when behind proxy/load balancer)
-    forwarded_for = request.headers.get("X-Forwarded-For")
+    forwarded_for = headers.get("x-forwarded-for")
     if forwarded_for:
-        # Take the first IP in the chain
-        return forwarded_for.split(",")[0].strip()
-    
-    # Check other common headers
-    real_ip = request.headers.get("X-Real-IP")
-    if real_ip:
-        return real_ip
-    
-    # Fallback to direct client IP
-    return request.client.host
-
-
-def should_redirect_to_app_store(platform: str, ios_url: Optional[str], android_url: Optional[str]) -> Tuple[bool, Optional[str]]:
+        # Take the first IP in the chain without splitting the whole header
+        comma = forwarded_for.find(",")
+        client_ip = _normalize_ip(forwarded_for[:comma] if comma >= 0 else forwarded_for)
+        if client_ip:
+            return client_ip
+
+    # Check other common headers, then fall back to direct client IP
+    return _normalize_ip(headers.get("x-real-ip")) or request.client.host
+
+
+def build_routing(link: Dict[str, Any]) -> Dict[str, List[str]]:
     """
-    Determine if we should redirect to app store based on platform and available URLs.
-    Returns: (should_redirect_to_store, store_url)
+    Server-side redirect targets as {platform: [url, redirect_type]}.
+    Mirrors the dynamic_links_routing() SQL function; only used for rows without a routing column.
     """
-    if platform == 'iOS' and not ios_url:
-        # Redirect to App Store if no iOS URL provided
-        return True, "https://apps.apple.com"
-    elif platform == 'Android' and not android_url:
-        # Redirect to Play Store if no Android URL provided
-        return True, "https://play.google.com"
-    
-    return False, None
+    fallback = [link['fallback_url'], 'fallback']
+    desktop_url = link.get('desktop_url')
+    return {'Desktop': [desktop_url, 'desktop'] if desktop_url else fallback, 'fallback': fallback}
 
 
 def build_redirect_url(base_url: str, parameters: Optional[Dict[str, Any]] = None) -> str:
-    """Build redirect URL with optional parameters."""
+    """Build redirect URL with optional, URL-encoded parameters."""
     if not parameters:
         return base_url
-    
-    # Add parameters to URL
-    param_string = "&".join([f"{k}={v}" for k, v in parameters.items() if v is not None])
+
+    filtered = {k: v for k, v in parameters.items() if v is not None}
+    if not filtered:
+        return base_url
+
     separator = "&" if "?" in base_url else "?"
-    
-    return f"{base_url}{separator}{param_string}" if param_string else base_url
+    return f"{base_url}{separator}{urlencode(filtered, doseq=True)}"
+
+
+def freeze_parameters(parameters: Optional[Dict[str, Any]]) -> Optional[str]:
+    """JSON key for a parameter dict: hashable, and it survives the JSON cache round trip.
+    Key order is kept so the cached URL matches build_redirect_url exactly."""
+    if not parameters:
+        return None
+    return orjson.dumps(parameters).decode()
+
+
+@lru_cache(maxsize=16384)
+def build_redirect_url_cached(base_url: str, frozen_parameters: Optional[str]) -> str:
+    """build_redirect_url memoized per link target; a link's custom parameters rarely change."""
+    if frozen_parameters is None:
+        return base_url
+    return build_redirect_url(base_url, orjson.loads(frozen_parameters))
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from app.db_pg import PostgresDB
+
+logger = logging.getLogger(__name__)
+
+# Aggregates every closed UTC day after the newest one already in link_analytics_daily.
+# A day counts as closed ten minutes after midnight, which leaves the analytics writer
+# time to flush its last clicks. Days are rolled up once and never revisited, so each
+# run reads at most the raw rows since the previous one (none, most of the day).
+# Referers are truncated to keep the primary key under the btree row size limit.
+ROLL_UP_CLOSED_DAYS = """
+    INSERT INTO link_analytics_daily (short_code, day, platform, country, referer, clicks)
+    SELECT short_code,
+           (clicked_at AT TIME ZONE 'UTC')::date,
+           COALESCE(platform, ''),
+           COALESCE(country, ''),
+           LEFT(COALESCE(referer, ''), 512),
+           COUNT(*)
+    FROM link_analytics
+    WHERE clicked_at >= COALESCE(
+              (SELECT (MAX(day) + 1)::timestamp AT TIME ZONE 'UTC' FROM link_analytics_daily),
+              '-infinity')
+      AND clicked_at < date_trunc('day', (now() - interval '10 minutes') AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+    GROUP BY 1, 2, 3, 4, 5
+    ON CONFLICT (short_code, day, platform, country, referer) DO UPDATE SET clicks = EXCLUDED.clicks;
+"""
+
+# Application-wide advisory lock key that keeps workers from rolling up the same days at once
+ROLLUP_LOCK_KEY = 7341002
+
+
+async def roll_up_closed_days(db: PostgresDB) -> bool:
+    """
+    Add newly closed days to link_analytics_daily. Returns False without doing anything
+    if another worker is rolling up right now. The lock is transaction-scoped, so no
+    connection is held between runs.
+    """
+    async with db.pool.acquire() as connection:
+        async with connection.transaction():
+            if not await connection.fetchval("SELECT pg_try_advisory_xact_lock($1);", ROLLUP_LOCK_KEY):
+                return False
+            await connection.execute(ROLL_UP_CLOSED_DAYS)
+    return True
+
+
+async def run_daily_rollup(db: PostgresDB, interval: int) -> None:
+    """Roll up closed days every interval seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await roll_up_closed_days(db)
+        except Exception:
+            logger.exception("Failed to roll up link_analytics_daily")
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from typing import Any, Optional, Tuple
+
+from app.db_pg import PostgresDB
+
+logger = logging.getLogger(__name__)
+
+ClickRow = Tuple[Any, ...]
+
+
+class AnalyticsWriter:
+    """
+    Buffers click rows in memory and writes them to link_analytics in batches,
+    so redirects never wait on the INSERT. A batch is written once it holds
+    batch_size rows or flush_interval seconds after its first row, whichever
+    comes first.
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 0.05, max_queued: int = 10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._db: Optional[PostgresDB] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, row: ClickRow) -> None:
+        """Queue a click row (the 14 db_pg.INSERT_CLICK parameters) without blocking."""
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            logger.warning("Analytics queue is full; dropping click for short code: %s", row[1])
+
+    async def start(self, db: PostgresDB) -> None:
+        self._db = db
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush everything queued so far, then stop the writer task."""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self.queue.get()
+            if row is None:
+                return
+
+            batch = [row]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        row = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    row = self.queue.get_nowait()
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            await self._write(batch)
+            if stopping:
+                return
+
+    async def _write(self, batch: list) -> None:
+        try:
+            await self._db.insert_clicks(batch)
+        except Exception:
+            logger.exception("Failed to write %d analytics rows", len(batch))
+
+
+# Global writer instance, started and stopped by the app lifespan
+analytics_writer = AnalyticsWriter()
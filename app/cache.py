@@ -1,53 +1,118 @@
-import redis
-from typing import Optional, Any
-import json
+import asyncio
+import redis.asyncio
+from typing import Optional, Any, Awaitable, List, Set
+import orjson
 from app.config import settings
 
+# INCR a fixed-window counter and start its TTL on the first hit, atomically.
+_INCR_WINDOW_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return count
+"""
+
 
 class RedisCache:
     def __init__(self):
-        self.redis_client = redis.from_url(settings.redis_url, decode_responses=True)
-    
+        # A blocking pool waits (briefly) for a free connection under load instead
+        # of failing with "Too many connections"; the socket timeouts keep a hung
+        # Redis from stalling every request, including the rate limiter's.
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            settings.redis_url,
+            decode_responses=False,
+            max_connections=settings.redis_max_connections,
+            timeout=settings.redis_timeout,
+            socket_connect_timeout=settings.redis_timeout,
+            socket_timeout=settings.redis_timeout,
+            health_check_interval=30,
+        )
+        self.redis_client = redis.asyncio.Redis.from_pool(pool)
+        self._incr_window = self.redis_client.register_script(_INCR_WINDOW_SCRIPT)
+
     async def get(self, key: str) -> Optional[Any]:
         """Get value from cache."""
         try:
-            value = self.redis_client.get(key)
+            value = await self.redis_client.get(key)
             if value:
-                return json.loads(value)
-        except Exception:
+                return orjson.loads(value)
+        except (redis.RedisError, orjson.JSONDecodeError):
             return None
         return None
-    
+
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        """Get the raw stored bytes, skipping deserialization."""
+        try:
+            return await self.redis_client.get(key)
+        except redis.RedisError:
+            return None
+
+    async def mget(self, *keys: str) -> List[Optional[bytes]]:
+        """Get the raw stored bytes for several keys in one round trip."""
+        try:
+            return await self.redis_client.mget(keys)
+        except redis.RedisError:
+            return [None] * len(keys)
+
+    async def set_bytes(self, key: str, value: bytes, expire: int = 3600) -> bool:
+        """Store already-serialized bytes with expiration."""
+        try:
+            return await self.redis_client.setex(key, expire, value)
+        except redis.RedisError:
+            return False
+
     async def set(self, key: str, value: Any, expire: int = 3600) -> bool:
         """Set value in cache with expiration."""
         try:
-            serialized_value = json.dumps(value, default=str)
-            return self.redis_client.setex(key, expire, serialized_value)
-        except Exception:
+            serialized_value = orjson.dumps(value, default=str)
+            return await self.redis_client.setex(key, expire, serialized_value)
+        except redis.RedisError:
             return False
-    
-    async def delete(self, key: str) -> bool:
-        """Delete key from cache."""
+
+    async def delete(self, *keys: str) -> bool:
+        """Delete keys from cache."""
         try:
-            return bool(self.redis_client.delete(key))
-        except Exception:
+            return bool(await self.redis_client.delete(*keys))
+        except redis.RedisError:
             return False
-    
+
     async def increment(self, key: str, amount: int = 1) -> int:
         """Increment counter in cache."""
         try:
-            return self.redis_client.incr(key, amount)
-        except Exception:
+            return await self.redis_client.incr(key, amount)
+        except redis.RedisError:
             return 0
-    
+
+    async def increment_window(self, key: str, window: int) -> Optional[int]:
+        """Increment a counter that expires `window` seconds after its first hit."""
+        try:
+            return await self._incr_window(keys=[key], args=[window])
+        except redis.RedisError:
+            return None
+
     async def set_with_ttl(self, key: str, value: Any, ttl: int) -> bool:
         """Set value with time-to-live."""
         try:
-            serialized_value = json.dumps(value, default=str)
-            return self.redis_client.setex(key, ttl, serialized_value)
-        except Exception:
+            serialized_value = orjson.dumps(value, default=str)
+            return await self.redis_client.setex(key, ttl, serialized_value)
+        except redis.RedisError:
             return False
 
+    async def close(self) -> None:
+        """Close the connection pool."""
+        await self.redis_client.aclose()
+
 
 # Global cache instance
 cache = RedisCache()
+
+# Strong references to in-flight fire-and-forget writes so they are not garbage collected
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def fire_and_forget(awaitable: Awaitable[Any]) -> None:
+    """Schedule a cache write without making the caller wait for the Redis round trip."""
+    task = asyncio.ensure_future(awaitable)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -6,9 +6,15 @@ import os
 class Settings(BaseSettings):
     # Database
     database_url: str
+    db_pool_min_size: int = 8
+    db_pool_max_size: int = 32
     
     # Redis
     redis_url: str = "redis://localhost:6379/0"
+    redis_max_connections: int = 64
+    # Seconds to wait for a pooled connection, a connect, or a reply before
+    # treating Redis as unavailable
+    redis_timeout: float = 0.25
     
     # Security
     secret_key: str
@@ -28,9 +34,15 @@ class Settings(BaseSettings):
     
     # Rate Limiting
     rate_limit_per_minute: int = 60
+    # Comma-separated CIDRs of the reverse proxies in front of the app (e.g. the
+    # ingress pods). Requests from these peers are limited by the client address
+    # they forward in X-Forwarded-For rather than by the proxy's own address.
+    trusted_proxies: str = ""
     
     # Analytics
     enable_analytics: bool = True
+    # How often to check for closed days to add to link_analytics_daily
+    analytics_rollup_interval_seconds: int = 600
     
     # GeoIP
     geoip_db_path: Optional[str] = None
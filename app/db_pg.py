@@ -1,9 +1,46 @@
 import asyncpg
+import orjson
 from asyncpg import Pool
+from asyncpg.prepared_stmt import PreparedStatement
 from app.config import settings
 
 db_instance = None
 
+# Hot-path redirect lookup; a single probe of the short_code unique index
+GET_LINK_FOR_REDIRECT = """
+    SELECT id, ios_url, android_url, fallback_url, routing, expires_at, custom_parameters,
+           title, social_title, social_description, social_image_url
+    FROM dynamic_links
+    WHERE short_code = $1 AND is_active;
+"""
+
+# One row per click, written in batches by the analytics writer
+INSERT_CLICK = """
+    INSERT INTO link_analytics (
+        link_id, short_code, ip_address, user_agent, referer, platform,
+        device_type, browser, os, country, region, city, redirected_to, redirect_type
+    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14);
+"""
+
+
+class PreparedConnection(asyncpg.Connection):
+    """Connection that carries the hot-path statements prepared once by the pool's init hook."""
+
+    stmt_get_link: PreparedStatement
+    stmt_insert_click: PreparedStatement
+
+
+async def _init_connection(connection: PreparedConnection):
+    # JSONB in and out as Python objects, encoded by orjson
+    await connection.set_type_codec(
+        "jsonb",
+        encoder=lambda value: orjson.dumps(value).decode(),
+        decoder=orjson.loads,
+        schema="pg_catalog",
+    )
+    connection.stmt_get_link = await connection.prepare(GET_LINK_FOR_REDIRECT)
+    connection.stmt_insert_click = await connection.prepare(INSERT_CLICK)
+
 
 class PostgresDB:
     def __init__(self):
@@ -12,7 +49,15 @@ class PostgresDB:
 
     async def connect(self):
         if not self.pool:
-            self.pool = await asyncpg.create_pool(dsn=self.dsn)
+            self.pool = await asyncpg.create_pool(
+                dsn=self.dsn,
+                min_size=settings.db_pool_min_size,
+                max_size=settings.db_pool_max_size,
+                max_inactive_connection_lifetime=300,
+                statement_cache_size=1024,
+                connection_class=PreparedConnection,
+                init=_init_connection,
+            )
 
     async def disconnect(self):
         if self.pool:
@@ -42,10 +87,22 @@ class PostgresDB:
             result = await connection.fetch(query, *args)
             return result
 
+    async def fetch_link(self, short_code: str) -> asyncpg.Record:
+        """Fetch an active link's redirect columns with the per-connection prepared statement."""
+        connection: PreparedConnection
+        async with self.pool.acquire() as connection:
+            return await connection.stmt_get_link.fetchrow(short_code)
+
+    async def insert_clicks(self, rows) -> None:
+        """Insert a batch of click rows with the per-connection prepared INSERT."""
+        connection: PreparedConnection
+        async with self.pool.acquire() as connection:
+            await connection.stmt_insert_click.executemany(rows)
+
 
 async def get_db_instance() -> PostgresDB:
     global db_instance
     if db_instance is None:
         db_instance = PostgresDB()
         await db_instance.connect()
-    return db_instance
\ No newline at end of file
+    return db_instance
@@ -2,22 +2,43 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, Response
 from fastapi.openapi.utils import get_openapi
-import time
+import asyncio
 import uvicorn
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 
+from app.analytics import close_geoip_reader
+from app.analytics_rollup import run_daily_rollup
+from app.analytics_writer import analytics_writer
+from app.cache import cache
 from app.config import settings
 from app.db_pg import get_db_instance
+from app.middleware import RateLimitTimingMiddleware, sweep_local_request_counts
+from app.responses import ORJSONResponse
 from app.routers import links, redirect, health
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    await get_db_instance()
+    db = await get_db_instance()
+    await analytics_writer.start(db)
+    background = [asyncio.create_task(sweep_local_request_counts())]
+    if settings.enable_analytics:
+        background.append(asyncio.create_task(
+            run_daily_rollup(db, settings.analytics_rollup_interval_seconds)
+        ))
+    # Build the OpenAPI schema now so the first docs request doesn't pay for it
+    if app.openapi_url:
+        app.openapi()
     yield
     # Shutdown
-    db = await get_db_instance()
+    for task in background:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await analytics_writer.stop()
     await db.disconnect()
+    await cache.close()
+    close_geoip_reader()
 
 # Initialize FastAPI app
 _docs_enabled = settings.debug and settings.environment != "production"
@@ -29,6 +50,7 @@ app = FastAPI(
     docs_url="/docs" if _docs_enabled else None,
     redoc_url="/redoc" if _docs_enabled else None,
     openapi_url="/openapi.json" if _docs_enabled else None,
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -41,14 +63,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Request timing middleware
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    return response
+# Rate limiting + request timing middleware
+app.add_middleware(RateLimitTimingMiddleware)
 
 # Global exception handler
 @app.exception_handler(Exception)
@@ -61,30 +77,6 @@ async def global_exception_handler(request: Request, exc: Exception):
         content={"detail": "Internal server error"}
     )
 
-# Rate limiting middleware (basic implementation)
-request_counts = {}
-
-@app.middleware("http")
-async def rate_limit_middleware(request: Request, call_next):
-    client_ip = request.client.host if request.client else "unknown"
-    current_time = time.time()
-
-    cutoff_time = current_time - 60
-    timestamps = [t for t in request_counts.get(client_ip, ()) if t > cutoff_time]
-
-    if len(timestamps) >= settings.rate_limit_per_minute:
-        request_counts[client_ip] = timestamps
-        return JSONResponse(
-            status_code=429,
-            content={"detail": "Rate limit exceeded"},
-            headers={"Retry-After": "60"},
-        )
-
-    timestamps.append(current_time)
-    request_counts[client_ip] = timestamps
-
-    return await call_next(request)
-
 # Include routers
 app.include_router(links.router)
 app.include_router(redirect.router)
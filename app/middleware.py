@@ -0,0 +1,128 @@
+import asyncio
+import ipaddress
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from starlette.datastructures import MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.cache import cache
+from app.config import settings
+
+# Per-process sliding window, used only while Redis is unreachable
+local_request_counts: Dict[str, Deque[float]] = {}
+
+_TRUSTED_PROXIES = tuple(
+    ipaddress.ip_network(cidr.strip(), strict=False)
+    for cidr in settings.trusted_proxies.split(",")
+    if cidr.strip()
+)
+
+
+class RateLimitTimingMiddleware:
+    """Rate limiting and the X-Process-Time-Us header in a single ASGI layer.
+
+    The limit is a fixed one-minute window shared across workers via Redis,
+    with a per-process fallback when Redis is down. Clients are keyed by
+    ``client_address``, so traffic relayed by a trusted proxy is not counted
+    against the proxy.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if await _rate_limited(client_address(scope)):
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": "Rate limit exceeded"},
+                headers={"Retry-After": "60"},
+            )
+            await response(scope, receive, send)
+            return
+
+        start = time.perf_counter_ns()
+
+        async def send_with_process_time(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("X-Process-Time-Us", str((time.perf_counter_ns() - start) // 1000))
+            await send(message)
+
+        await self.app(scope, receive, send_with_process_time)
+
+
+def client_address(scope: Scope) -> str:
+    """Address to rate limit a request by.
+
+    This is the socket peer, unless the peer is a trusted proxy. Then it is the
+    nearest X-Forwarded-For hop that is not itself a trusted proxy. Hops are
+    walked right to left, because everything left of the first untrusted hop is
+    client-supplied and can be spoofed.
+    """
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    if not _TRUSTED_PROXIES or not _is_trusted_proxy(_parse_ip(peer)):
+        return peer
+
+    forwarded = b",".join(
+        value for name, value in scope.get("headers", ()) if name == b"x-forwarded-for"
+    )
+    for hop in reversed(forwarded.decode("latin-1").split(",")):
+        hop_ip = _parse_ip(hop.strip())
+        if hop_ip is None:
+            break
+        if not _is_trusted_proxy(hop_ip):
+            return str(hop_ip)
+    return peer
+
+
+def _parse_ip(value: str) -> Optional[ipaddress._BaseAddress]:
+    if not value or len(value) > 45:
+        return None
+    try:
+        return ipaddress.ip_address(value)
+    except ValueError:
+        return None
+
+
+def _is_trusted_proxy(ip: Optional[ipaddress._BaseAddress]) -> bool:
+    return ip is not None and any(ip in network for network in _TRUSTED_PROXIES)
+
+
+async def _rate_limited(client_ip: str) -> bool:
+    window = int(time.time() // 60)
+    count = await cache.increment_window(f"rl:{client_ip}:{window}", 60)
+    if count is None:
+        return _local_rate_limited(client_ip)
+    return count > settings.rate_limit_per_minute
+
+
+def _local_rate_limited(client_ip: str) -> bool:
+    timestamps = local_request_counts.setdefault(client_ip, deque())
+    now = time.monotonic()
+    cutoff = now - 60
+    while timestamps and timestamps[0] < cutoff:
+        timestamps.popleft()
+
+    if len(timestamps) >= settings.rate_limit_per_minute:
+        return True
+
+    timestamps.append(now)
+    return False
+
+
+async def sweep_local_request_counts():
+    """Drop clients whose fallback window has fully expired."""
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.monotonic() - 60
+        for client_ip, timestamps in list(local_request_counts.items()):
+            if not timestamps or timestamps[-1] < cutoff:
+                local_request_counts.pop(client_ip, None)
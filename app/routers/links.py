@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
-from typing import List, Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import UUID
+import anyio
 import logging
 import qrcode
 from io import BytesIO
+from PIL import Image, ImageOps
 import base64
-import json
 from app.db_pg import PostgresDB, get_db_instance
 from app.schemas import (
     DynamicLinkCreate,
@@ -16,14 +18,64 @@ from app.schemas import (
 )
 from app.utils import generate_unique_short_code, generate_custom_short_code, hash_ip_address
 from app.analytics import detect_platform_and_device, get_location_from_ip, get_client_ip
-from app.cache import cache
+from app.analytics_writer import analytics_writer
+from app.cache import cache, fire_and_forget
 from app.config import settings
+from app.responses import dumps
 from app.security import require_api_key
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1/links", tags=["Dynamic Links"])
 
+# Row columns exposed by DynamicLinkResponse (short_url is derived, creator_id stays private)
+_LINK_FIELDS = tuple(field for field in DynamicLinkResponse.model_fields if field != "short_url")
+
+
+URL_FIELDS = frozenset({"ios_url", "android_url", "fallback_url", "desktop_url", "image_url", "social_image_url"})
+
+# Columns written on create, in the order of the $2..$15 placeholders ($1 is short_code)
+_INSERT_COLUMNS = (
+    "ios_url", "android_url", "fallback_url", "desktop_url", "title",
+    "description", "image_url", "social_title", "social_description", "social_image_url",
+    "is_active", "expires_at", "creator_id", "custom_parameters",
+)
+_INSERT_SQL = f"""
+    INSERT INTO dynamic_links (short_code, {", ".join(_INSERT_COLUMNS)})
+    VALUES ({", ".join(f"${i}" for i in range(1, len(_INSERT_COLUMNS) + 2))})
+    RETURNING *;
+"""
+
+
+def _coerce(link_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert URL objects to str for asyncpg; JSONB goes through the pool's codec."""
+    return {
+        field: str(value) if field in URL_FIELDS and value is not None else value
+        for field, value in link_dict.items()
+    }
+
+
+@lru_cache(maxsize=256)
+def _build_update_sql(fields: Tuple[str, ...]) -> str:
+    """Build the UPDATE statement for a given set of fields; identical shapes reuse the string."""
+    set_clause = ", ".join(f"{field} = ${i}" for i, field in enumerate(fields, start=1))
+    return (
+        f"UPDATE dynamic_links SET {set_clause}, updated_at = now() "
+        f"WHERE short_code = ${len(fields) + 1} RETURNING *;"
+    )
+
+
+def _link_payload(db_link, short_domain: str) -> dict:
+    """Build the public response dict straight from a trusted database row."""
+    payload = {field: db_link.get(field) for field in _LINK_FIELDS}
+    payload["short_url"] = f"{short_domain}/{db_link['short_code']}"
+    return payload
+
+
+def _cache_entry(link_id, body: bytes) -> bytes:
+    """link:{code} value: the link id on its own line, then the response body, so hits skip JSON parsing."""
+    return f"{link_id}\n".encode() + body
+
 
 @router.post("/", response_model=DynamicLinkResponse, dependencies=[Depends(require_api_key)])
 async def create_dynamic_link(
@@ -45,45 +97,15 @@ async def create_dynamic_link(
         short_code = await generate_unique_short_code(db)
 
     # Create the link
-    link_dict = link_data.model_dump()
-    query = """
-        INSERT INTO dynamic_links (
-            short_code, ios_url, android_url, fallback_url, desktop_url, title,
-            description, image_url, social_title, social_description, social_image_url,
-            is_active, expires_at, creator_id, custom_parameters
-        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
-        RETURNING *;
-    """
-    
-    db_link = await db.fetchrow(
-        query,
-        short_code,
-        str(link_dict.get("ios_url")) if link_dict.get("ios_url") else None,
-        str(link_dict.get("android_url")) if link_dict.get("android_url") else None,
-        str(link_dict.get("fallback_url")) if link_dict.get("fallback_url") else None,
-        str(link_dict.get("desktop_url")) if link_dict.get("desktop_url") else None,
-        link_dict.get("title"),
-        link_dict.get("description"),
-        str(link_dict.get("image_url")) if link_dict.get("image_url") else None,
-        link_dict.get("social_title"),
-        link_dict.get("social_description"),
-        str(link_dict.get("social_image_url")) if link_dict.get("social_image_url") else None,
-        link_dict.get("is_active", True),
-        link_dict.get("expires_at"),
-        link_dict.get("creator_id"),
-        json.dumps(link_dict.get("custom_parameters")) if link_dict.get("custom_parameters") else None,
-    )
+    link_dict = _coerce(link_data.model_dump())
+    link_dict.setdefault("is_active", True)
+    db_link = await db.fetchrow(_INSERT_SQL, short_code, *(link_dict.get(column) for column in _INSERT_COLUMNS))
 
-    # Build response with short URL
-    db_link_dict = dict(db_link)
-    db_link_dict["short_url"] = f"{settings.short_domain}/{short_code}"
-    response_data = DynamicLinkResponse.model_validate(db_link_dict)
-
-    # Cache the link for faster access
-    cache_key = f"link:{short_code}"
-    await cache.set(cache_key, response_data.model_dump_json(), expire=3600)
+    # Serialize once and reuse the body for both the cache and the HTTP response
+    body = dumps(_link_payload(db_link, settings.short_domain))
+    fire_and_forget(cache.set_bytes(f"link:{short_code}", _cache_entry(db_link["id"], body), expire=3600))
 
-    return response_data
+    return Response(content=body, media_type="application/json")
 
 
 @router.get("/", response_model=List[DynamicLinkResponse], dependencies=[Depends(require_api_key)])
@@ -94,6 +116,12 @@ async def list_dynamic_links(
     db: PostgresDB = Depends(get_db_instance)
 ):
     """List dynamic links with pagination."""
+    # Short-lived page cache absorbs bursts of identical list requests
+    cache_key = f"links:list:{active_only}:{skip}:{limit}"
+    cached_page = await cache.get_bytes(cache_key)
+    if cached_page:
+        return Response(content=cached_page, media_type="application/json", headers={"X-Cache": "HIT"})
+
     if active_only:
         query = "SELECT * FROM dynamic_links WHERE is_active = TRUE ORDER BY created_at DESC LIMIT $1 OFFSET $2;"
         links = await db.fetch(query, limit, skip)
@@ -101,37 +129,35 @@ async def list_dynamic_links(
         query = "SELECT * FROM dynamic_links ORDER BY created_at DESC LIMIT $1 OFFSET $2;"
         links = await db.fetch(query, limit, skip)
     
-    response_links = []
-    for link in links:
-        link_dict = dict(link)
-        link_dict["short_url"] = f"{settings.short_domain}/{link['short_code']}"
-        response_data = DynamicLinkResponse.model_validate(link_dict)
-        response_links.append(response_data)
+    # Rows come from our own table, so skip per-item validation and encode the page once
+    domain = settings.short_domain
+    body = dumps([_link_payload(link, domain) for link in links])
+    await cache.set_bytes(cache_key, body, expire=5)
 
-    return response_links
+    return Response(content=body, media_type="application/json", headers={"X-Cache": "MISS"})
 
 
 @router.get("/{short_code}", response_model=DynamicLinkResponse)
 async def get_dynamic_link(short_code: str, request: Request, db: PostgresDB = Depends(get_db_instance)):
     """Get a specific dynamic link by short code. Called by mobile apps to resolve short links."""
 
-    # Try cache first
+    # Try cache first; the cached value is the link id followed by the serialized response body
     cache_key = f"link:{short_code}"
-    cached_link = await cache.get(cache_key)
-    link_id = None
-
-    if cached_link:
-        try:
-            response_data = DynamicLinkResponse.model_validate_json(cached_link)
-            link_id = response_data.id
-        except Exception:
-            # Cache data is corrupted, delete it and fetch from database
+    cached = await cache.get_bytes(cache_key)
+    cache_status = "HIT"
+    link_id = body = None
+
+    if cached:
+        cached_id, separator, body = cached.partition(b"\n")
+        if separator:
+            link_id = cached_id.decode()
+        else:
+            # Cache data is corrupted or in an older format, delete it and fetch from database
             await cache.delete(cache_key)
-            response_data = None
-    else:
-        response_data = None
+            body = None
 
-    if response_data is None:
+    if not body:
+        cache_status = "MISS"
         # Query database
         query = "SELECT * FROM dynamic_links WHERE short_code = $1;"
         db_link = await db.fetchrow(query, short_code)
@@ -142,13 +168,11 @@ async def get_dynamic_link(short_code: str, request: Request, db: PostgresDB = D
                 detail="Dynamic link not found"
             )
 
-        db_link_dict = dict(db_link)
-        link_id = db_link_dict["id"]
-        db_link_dict["short_url"] = f"{settings.short_domain}/{short_code}"
-        response_data = DynamicLinkResponse.model_validate(db_link_dict)
+        link_id = db_link["id"]
+        body = dumps(_link_payload(db_link, settings.short_domain))
 
         # Cache for future requests
-        await cache.set(cache_key, response_data.model_dump_json(), expire=3600)
+        await cache.set_bytes(cache_key, _cache_entry(link_id, body), expire=3600)
 
     # Track analytics (app-resolved links)
     if settings.enable_analytics and link_id:
@@ -159,14 +183,7 @@ async def get_dynamic_link(short_code: str, request: Request, db: PostgresDB = D
             platform, device_type, browser, os = detect_platform_and_device(user_agent_string)
             country, region, city = get_location_from_ip(client_ip)
 
-            analytics_query = """
-                INSERT INTO link_analytics (
-                    link_id, short_code, ip_address, user_agent, referer, platform,
-                    device_type, browser, os, country, region, city, redirected_to, redirect_type
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14);
-            """
-            await db.execute(
-                analytics_query,
+            analytics_writer.submit((
                 link_id,
                 short_code,
                 hash_ip_address(client_ip),
@@ -181,15 +198,14 @@ async def get_dynamic_link(short_code: str, request: Request, db: PostgresDB = D
                 city,
                 "app-resolved",
                 "api",
-            )
+            ))
 
-            # Update click counter in cache
-            click_key = f"clicks:{short_code}"
-            await cache.increment(click_key)
+            # Update click counter in cache without holding up the response
+            fire_and_forget(cache.increment(f"clicks:{short_code}"))
         except Exception:
             logger.exception("Failed to track analytics for short code: %s", short_code)
 
-    return response_data
+    return Response(content=body, media_type="application/json", headers={"X-Cache": cache_status})
 
 
 @router.put("/{short_code}", response_model=DynamicLinkResponse, dependencies=[Depends(require_api_key)])
@@ -204,23 +220,9 @@ async def update_dynamic_link(
     if not update_data:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields to update")
 
-    set_clauses = []
-    values = []
-    i = 1
-    url_fields = ["ios_url", "android_url", "fallback_url", "desktop_url", "image_url", "social_image_url"]
-    for field, value in update_data.items():
-        if field == "custom_parameters":
-            value = json.dumps(value)
-        elif field in url_fields and value is not None:
-            value = str(value)
-        set_clauses.append(f"{field} = ${i}")
-        values.append(value)
-        i += 1
-
-    values.append(short_code)
-    query = f"UPDATE dynamic_links SET {', '.join(set_clauses)}, updated_at = now() WHERE short_code = ${i} RETURNING *;"
-    
-    db_link = await db.fetchrow(query, *values)
+    update_data = _coerce(update_data)
+    query = _build_update_sql(tuple(update_data))
+    db_link = await db.fetchrow(query, *update_data.values(), short_code)
 
     if not db_link:
         raise HTTPException(
@@ -228,14 +230,15 @@ async def update_dynamic_link(
             detail="Dynamic link not found"
         )
 
-    # Update cache
-    cache_key = f"link:{short_code}"
-    db_link_dict = dict(db_link)
-    db_link_dict["short_url"] = f"{settings.short_domain}/{short_code}"
-    response_data = DynamicLinkResponse.model_validate(db_link_dict)
-    await cache.set(cache_key, response_data.model_dump_json(), expire=3600)
+    # Drop the redirect entries before responding, so no redirect serves the old target
+    # after the PUT returns; refreshing the link body can happen in the background.
+    await cache.delete(
+        f"redirect:{short_code}", f"html:{short_code}:ios", f"html:{short_code}:android"
+    )
+    body = dumps(_link_payload(db_link, settings.short_domain))
+    fire_and_forget(cache.set_bytes(f"link:{short_code}", _cache_entry(db_link["id"], body), expire=3600))
 
-    return response_data
+    return Response(content=body, media_type="application/json")
 
 
 @router.delete("/{short_code}", dependencies=[Depends(require_api_key)])
@@ -251,8 +254,9 @@ async def delete_dynamic_link(short_code: str, db: PostgresDB = Depends(get_db_i
         )
 
     # Remove from cache
-    cache_key = f"link:{short_code}"
-    await cache.delete(cache_key)
+    await cache.delete(
+        f"link:{short_code}", f"redirect:{short_code}", f"html:{short_code}:ios", f"html:{short_code}:android"
+    )
 
     return {"message": "Dynamic link deactivated successfully"}
 
@@ -276,29 +280,47 @@ async def generate_qr_code(
             detail="Dynamic link not found or inactive"
         )
 
-    # Generate QR code
+    media_type = f"image/{format.lower()}"
+    headers = {"Content-Disposition": f"inline; filename=qr_{short_code}.{format.lower()}"}
+
+    # The image is deterministic per (link, size, border, format), so serve repeats from cache
+    cache_key = f"qr:{short_code}:{size}:{border}:{format}"
+    cached_image = await cache.get_bytes(cache_key)
+    if cached_image:
+        return Response(content=cached_image, media_type=media_type, headers=headers)
+
+    # Rendering is CPU-bound; keep it off the event loop
     short_url = f"{settings.short_domain}/{short_code}"
+    image = await anyio.to_thread.run_sync(_render_qr, short_url, size, border, format)
+    await cache.set_bytes(cache_key, image, expire=86400)
+
+    return Response(content=image, media_type=media_type, headers=headers)
+
+
+@lru_cache(maxsize=4096)
+def _qr_modules(url: str) -> Image.Image:
+    """Encode url once and keep its bare module grid as a 1-bit image (one pixel per module)."""
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=size // 25,  # Adjust box size based on requested size
-        border=border,
+        border=0,
     )
-    qr.add_data(short_url)
+    qr.add_data(url)
     qr.make(fit=True)
 
-    # Create image
-    img = qr.make_image(fill_color="black", back_color="white")
+    matrix = qr.get_matrix()
+    pixels = bytes(0 if dark else 255 for row in matrix for dark in row)
+    return Image.frombytes("L", (len(matrix), len(matrix)), pixels).convert("1", dither=Image.Dither.NONE)
+
+
+def _render_qr(url: str, size: int, border: int, format: str) -> bytes:
+    """Render the QR code image for url and return the encoded bytes."""
+    # Reed-Solomon encoding and masking are cached per URL; only scaling runs per request
+    img = ImageOps.expand(_qr_modules(url), border=border, fill=255)
+    box_size = size // 25  # Adjust box size based on requested size
+    img = img.resize((img.width * box_size, img.height * box_size), Image.Resampling.NEAREST)
 
     # Save to BytesIO
     img_buffer = BytesIO()
     img.save(img_buffer, format=format)
-    img_buffer.seek(0)
-
-    # Return image response
-    media_type = f"image/{format.lower()}"
-    return Response(
-        content=img_buffer.getvalue(),
-        media_type=media_type,
-        headers={"Content-Disposition": f"inline; filename=qr_{short_code}.{format.lower()}"}
-    )
+    return img_buffer.getvalue()
@@ -1,96 +1,118 @@
 from fastapi import APIRouter, Depends, Request, Response, HTTPException, status
-import json
 import logging
+import time
 from datetime import datetime, timedelta, timezone
+from html import escape
+from string import Template
 from typing import Optional, Dict, Any
 
+import orjson
+
 from app.db_pg import PostgresDB, get_db_instance
 from app.schemas import LinkAnalyticsResponse
 from app.analytics import (
     detect_platform_and_device, 
     get_location_from_ip, 
     get_client_ip,
-    should_redirect_to_app_store,
-    build_redirect_url
+    build_redirect_url,
+    build_redirect_url_cached,
+    build_routing,
+    freeze_parameters,
 )
-from app.cache import cache
+from app.analytics_writer import analytics_writer
+from app.cache import cache, fire_and_forget
 from app.config import settings
+from app.responses import ORJSONResponse
 from app.security import require_api_key
 from app.utils import hash_ip_address
-from fastapi.responses import HTMLResponse
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Redirect & Analytics"])
 
-def generate_redirect_html(
-    ios_url: Optional[str],
-    android_url: Optional[str],
-    fallback_url: str,
-    social_title: Optional[str] = None,
-    social_description: Optional[str] = None,
-    social_image_url: Optional[str] = None,
-) -> str:
-    """Generates an HTML page with JavaScript for mobile redirection."""
-
-    ios_deep_link = ios_url or ""
-    android_deep_link = android_url or ""
-
-    return f"""
+# Served only to iOS and Android, which the server has already told apart, so the
+# page carries just that platform's deep link and no user-agent sniffing.
+_REDIRECT_HTML = Template("""
     <!DOCTYPE html>
     <html>
     <head>
-        <title>{social_title or 'Redirecting...'}</title>
-        <meta property="og:title" content="{social_title or ''}" />
-        <meta property="og:description" content="{social_description or ''}" />
-        <meta property="og:image" content="{social_image_url or ''}" />
+        <title>$title</title>
+        <meta property="og:title" content="$og_title" />
+        <meta property="og:description" content="$og_description" />
+        <meta property="og:image" content="$og_image" />
         <script type="text/javascript">
-            function redirect() {{
-                var userAgent = navigator.userAgent || navigator.vendor || window.opera;
-                var fallback = '{fallback_url}';
-                var deepLink;
-                var storeUrl;
-
-                if (/iPad|iPhone|iPod/.test(userAgent) && !window.MSStream) {{
-                    deepLink = '{ios_deep_link}';
-                    storeUrl = fallback; 
-                }} else if (/android/i.test(userAgent)) {{
-                    deepLink = '{android_deep_link}';
-                    storeUrl = fallback;
-                }} else {{
-                    window.location = fallback;
-                    return;
-                }}
+            function redirect() {
+                var fallback = $fallback_js;
+                var deepLink = $deep_link_js;
 
-                if (!deepLink) {{
-                    window.location = storeUrl;
+                if (!deepLink) {
+                    window.location = fallback;
                     return;
-                }}
+                }
 
                 window.location = deepLink;
 
-                var timeout = setTimeout(function() {{
-                    window.location = storeUrl;
-                }}, 1500);
+                var timeout = setTimeout(function() {
+                    window.location = fallback;
+                }, 1500);
 
-                function onVisibilityChange() {{
-                    if (document.hidden || document.webkitHidden) {{
+                function onVisibilityChange() {
+                    if (document.hidden || document.webkitHidden) {
                         clearTimeout(timeout);
-                    }}
-                }}
+                    }
+                }
 
                 document.addEventListener("visibilitychange", onVisibilityChange, false);
                 document.addEventListener("webkitvisibilitychange", onVisibilityChange, false);
-            }}
+            }
             window.onload = redirect;
         </script>
     </head>
     <body>
-        <p>If you are not redirected automatically, <a href="{fallback_url}">click here</a>.</p>
+        <p>If you are not redirected automatically, <a href="$fallback_href">click here</a>.</p>
     </body>
     </html>
-    """
+    """)
+
+
+def _js_string(value: Optional[str]) -> str:
+    """Quote a value as a JavaScript string literal that is safe inside <script>."""
+    return orjson.dumps(value or "").decode().replace("<", "\\u003c")
+
+
+def generate_redirect_html(
+    deep_link: Optional[str],
+    fallback_url: str,
+    social_title: Optional[str] = None,
+    social_description: Optional[str] = None,
+    social_image_url: Optional[str] = None,
+) -> str:
+    """Generates an HTML page that opens the platform's deep link, falling back to fallback_url."""
+    return _REDIRECT_HTML.substitute(
+        title=escape(social_title or 'Redirecting...'),
+        og_title=escape(social_title or ''),
+        og_description=escape(social_description or ''),
+        og_image=escape(social_image_url or ''),
+        fallback_js=_js_string(fallback_url),
+        deep_link_js=_js_string(deep_link),
+        fallback_href=escape(fallback_url),
+    )
+
+
+def _render_mobile_page(db_link_data: Dict[str, Any], platform: str, passthrough_params: Dict[str, str]) -> bytes:
+    """Render the iOS or Android redirect page as UTF-8 bytes, forwarding query params to the deep link."""
+    deep_link = db_link_data.get('ios_url' if platform == 'iOS' else 'android_url')
+    if deep_link and passthrough_params:
+        deep_link = build_redirect_url(deep_link, passthrough_params)
+
+    return generate_redirect_html(
+        deep_link=deep_link,
+        fallback_url=db_link_data.get('fallback_url'),
+        social_title=db_link_data.get('social_title'),
+        social_description=db_link_data.get('social_description'),
+        social_image_url=db_link_data.get('social_image_url')
+    ).encode()
 
 
 @router.get("/{short_code}")
@@ -101,15 +123,39 @@ async def redirect_dynamic_link(
 ):
     """Handle dynamic link redirect with analytics tracking."""
 
-    # Get link from cache or database
-    cache_key = f"link:{short_code}"
-    cached_link = await cache.get(cache_key)
+    # Extract request information
+    user_agent_string = request.headers.get("User-Agent", "")
+    client_ip = get_client_ip(request)
+    referer = request.headers.get("Referer")
+
+    # Detect platform and device
+    platform, device_type, browser, os = detect_platform_and_device(user_agent_string)
+    is_mobile = platform in ['iOS', 'Android']
 
+    # Collect query params from the incoming request (e.g. ?source=email)
+    # and forward them to the target deep link URLs so the app can read them.
+    passthrough_params = dict(request.query_params)
+
+    # Get link from cache or database. Stored apart from the link:{code} entry,
+    # which holds the serialized API response rather than the raw row.
+    # The mobile page only varies with platform and passthrough params, so the plain
+    # case is cached per link and platform and read in the same round trip as the link.
+    cache_key = f"redirect:{short_code}"
+    html_key = f"html:{short_code}:{platform.lower()}"
+    use_html_cache = is_mobile and not passthrough_params
+    cached = await cache.mget(cache_key, html_key) if use_html_cache else await cache.mget(cache_key)
+    cached_link = cached[0]
+    html_content = cached[1] if use_html_cache else None
+
+    db_link_data = None
     if cached_link:
-        db_link_data = json.loads(cached_link)
-    else:
-        query = "SELECT * FROM dynamic_links WHERE short_code = $1 AND is_active = TRUE;"
-        db_link = await db.fetchrow(query, short_code)
+        try:
+            db_link_data = orjson.loads(cached_link)
+        except orjson.JSONDecodeError:
+            # Unreadable entry; drop it and reload the link as on a miss
+            await cache.delete(cache_key)
+    if db_link_data is None:
+        db_link = await db.fetch_link(short_code)
 
         if not db_link:
             raise HTTPException(
@@ -117,24 +163,21 @@ async def redirect_dynamic_link(
                 detail="Link not found or inactive"
             )
 
-        # Check if expired
-        if db_link['expires_at'] and db_link['expires_at'] < datetime.now(timezone.utc):
-            raise HTTPException(
-                status_code=status.HTTP_410_GONE,
-                detail="Link has expired"
-            )
-
         db_link_data = dict(db_link)
+        # Expiry as epoch seconds, so the per-request check is a float comparison
+        expires_at = db_link['expires_at']
+        db_link_data['_exp_ts'] = expires_at.timestamp() if expires_at else 0
+        # Frozen once here so every redirect can reuse the memoized URL build
+        db_link_data['_params_key'] = freeze_parameters(db_link_data.get('custom_parameters'))
         # Cache for future requests
-        await cache.set(cache_key, json.dumps(db_link_data, default=str), expire=3600)
-
-    # Extract request information
-    user_agent_string = request.headers.get("User-Agent", "")
-    client_ip = get_client_ip(request)
-    referer = request.headers.get("Referer")
+        fire_and_forget(cache.set(cache_key, db_link_data, expire=3600))
 
-    # Detect platform and device
-    platform, device_type, browser, os = detect_platform_and_device(user_agent_string)
+    # Check if expired; cached entries can outlive expires_at
+    if db_link_data.get('_exp_ts') and db_link_data['_exp_ts'] < time.time():
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Link has expired"
+        )
 
     # Get location (if GeoIP is enabled)
     country, region, city = get_location_from_ip(client_ip)
@@ -142,23 +185,16 @@ async def redirect_dynamic_link(
     # Determine redirect URL
     redirect_url = None
     redirect_type = None
-    is_mobile = platform in ['iOS', 'Android']
-
-    # Collect query params from the incoming request (e.g. ?source=email)
-    # and forward them to the target deep link URLs so the app can read them.
-    passthrough_params = dict(request.query_params)
 
     if not is_mobile:
-        if platform == 'Desktop' and db_link_data.get('desktop_url'):
-            redirect_url = db_link_data['desktop_url']
-            redirect_type = 'desktop'
-        else:
-            redirect_url = db_link_data['fallback_url']
-            redirect_type = 'fallback'
+        # Targets are resolved at write time; only rows cached before that need building here
+        routing = db_link_data.get('routing') or build_routing(db_link_data)
+        redirect_url, redirect_type = routing.get(platform) or routing['fallback']
 
         # Add custom parameters for server-side redirects
         if db_link_data.get('custom_parameters'):
-            redirect_url = build_redirect_url(redirect_url, db_link_data['custom_parameters'])
+            params_key = db_link_data.get('_params_key') or freeze_parameters(db_link_data['custom_parameters'])
+            redirect_url = build_redirect_url_cached(redirect_url, params_key)
         if passthrough_params:
             redirect_url = build_redirect_url(redirect_url, passthrough_params)
     else:
@@ -167,42 +203,36 @@ async def redirect_dynamic_link(
         redirect_url = f"html-redirect-for-{platform.lower()}"
         redirect_type = platform.lower()
 
-    # 🎯 LOG REDIRECT DETAILS TO STDOUT
-    print("=" * 80)
-    print(f"REDIRECT EVENT - {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}")
-    print("=" * 80)
-    print(f"Short Code:     {short_code}")
-    print(f"Client IP:      {client_ip}")
-    print(f"Platform:       {platform} | {device_type}")
-    print(f"Browser:        {browser}")
-    print(f"OS:             {os}")
-    print(f"Location:       {city}, {region}, {country}" if country else "Location:       Unknown")
-    print(f"Redirect Type:  {redirect_type}")
-    
-    if is_mobile:
-        print(f"Mobile Targets:")
-        print(f"  iOS URL:        {db_link_data.get('ios_url', 'Not set')}")
-        print(f"  Android URL:    {db_link_data.get('android_url', 'Not set')}")
-        print(f"  Fallback URL:   {db_link_data.get('fallback_url')}")
-        print(f"Response:       HTML page with JavaScript redirect")
-    else:
-        print(f"Target URL:     {redirect_url}")
-        print(f"Response:       HTTP 302 redirect")
-    
-    print(f"Referer:        {referer if referer else 'Direct'}")
-    print(f"Title:          {db_link_data.get('title', 'No title')}")
-    print("=" * 80)
-
-    # Track analytics (if enabled)
+    # 🎯 LOG REDIRECT DETAILS TO STDOUT (debug only, so production skips the formatting)
+    if settings.debug:
+        print("=" * 80)
+        print(f"REDIRECT EVENT - {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}")
+        print("=" * 80)
+        print(f"Short Code:     {short_code}")
+        print(f"Client IP:      {client_ip}")
+        print(f"Platform:       {platform} | {device_type}")
+        print(f"Browser:        {browser}")
+        print(f"OS:             {os}")
+        print(f"Location:       {city}, {region}, {country}" if country else "Location:       Unknown")
+        print(f"Redirect Type:  {redirect_type}")
+
+        if is_mobile:
+            print(f"Mobile Targets:")
+            print(f"  iOS URL:        {db_link_data.get('ios_url', 'Not set')}")
+            print(f"  Android URL:    {db_link_data.get('android_url', 'Not set')}")
+            print(f"  Fallback URL:   {db_link_data.get('fallback_url')}")
+            print(f"Response:       HTML page with JavaScript redirect")
+        else:
+            print(f"Target URL:     {redirect_url}")
+            print(f"Response:       HTTP 307 redirect")
+
+        print(f"Referer:        {referer if referer else 'Direct'}")
+        print(f"Title:          {db_link_data.get('title', 'No title')}")
+        print("=" * 80)
+
+    # Track analytics (if enabled); the row is written in the background by the batch writer
     if settings.enable_analytics:
-        query = """
-            INSERT INTO link_analytics (
-                link_id, short_code, ip_address, user_agent, referer, platform,
-                device_type, browser, os, country, region, city, redirected_to, redirect_type
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14);
-        """
-        await db.execute(
-            query,
+        analytics_writer.submit((
             db_link_data['id'],
             short_code,
             hash_ip_address(client_ip),  # Hash for privacy
@@ -216,41 +246,86 @@ async def redirect_dynamic_link(
             region,
             city,
             redirect_url,
-            redirect_type
-        )
+            redirect_type,
+        ))
 
-        # Update click counter in cache
-        click_key = f"clicks:{short_code}"
-        await cache.increment(click_key)
+        # Update click counter in cache without holding up the response
+        fire_and_forget(cache.increment(f"clicks:{short_code}"))
 
     if is_mobile:
-        # Forward query params to mobile deep link URLs
-        ios_url = db_link_data.get('ios_url')
-        android_url = db_link_data.get('android_url')
-        fallback_url = db_link_data.get('fallback_url')
-        if passthrough_params:
-            if ios_url:
-                ios_url = build_redirect_url(ios_url, passthrough_params)
-            if android_url:
-                android_url = build_redirect_url(android_url, passthrough_params)
-
-        html_content = generate_redirect_html(
-            ios_url=ios_url,
-            android_url=android_url,
-            fallback_url=fallback_url,
-            social_title=db_link_data.get('social_title'),
-            social_description=db_link_data.get('social_description'),
-            social_image_url=db_link_data.get('social_image_url')
+        if html_content is None:
+            html_content = _render_mobile_page(db_link_data, platform, passthrough_params)
+            if use_html_cache:
+                fire_and_forget(cache.set_bytes(html_key, html_content, expire=3600))
+        # Already-encoded bytes. no-store, like the desktop redirect, so every tap is
+        # counted and an update or delete takes effect immediately.
+        return Response(
+            content=html_content,
+            media_type="text/html",
+            headers={"Cache-Control": "no-store"}
         )
-        return HTMLResponse(content=html_content)
     else:
-        # Perform server-side redirect for desktop/other
+        # Perform server-side redirect for desktop/other. 307 keeps the request method,
+        # and no-store makes every click come back here to be counted.
         return Response(
-            status_code=status.HTTP_302_FOUND,
-            headers={"Location": redirect_url}
+            status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+            headers={"Location": redirect_url, "Cache-Control": "no-store"}
         )
 
 
+# Whole days from $3 come from the link_analytics_daily rollup, up to raw_from: the start
+# of yesterday ($4), or the first day the rollup doesn't hold yet if it is further behind.
+# Everything else in the window is aggregated from raw rows: the partial first day
+# [$2, $3) and everything from raw_from on. Referers are truncated as in the rollup.
+# Unique clicks can't be summed across days, so they are counted from the raw rows
+# (an index-only scan of idx_link_analytics_short_code_clicked_at).
+ANALYTICS_QUERY = """
+    WITH bounds AS (
+        SELECT LEAST($4::timestamptz, COALESCE(
+            (SELECT (MAX(day) + 1)::timestamp AT TIME ZONE 'UTC' FROM link_analytics_daily),
+            '-infinity'
+        )) AS raw_from
+    ),
+    raw AS (
+        SELECT clicked_at, platform, country, referer
+        FROM link_analytics, bounds
+        WHERE short_code = $1 AND clicked_at >= $2::timestamptz AND clicked_at < LEAST($3::timestamptz, raw_from)
+        UNION ALL
+        SELECT clicked_at, platform, country, referer
+        FROM link_analytics, bounds
+        WHERE short_code = $1 AND clicked_at >= GREATEST($2::timestamptz, raw_from)
+    ),
+    daily AS (
+        SELECT day, platform, country, referer, clicks
+        FROM link_analytics_daily, bounds
+        WHERE short_code = $1
+          AND day >= ($3::timestamptz AT TIME ZONE 'UTC')::date
+          AND day < (raw_from AT TIME ZONE 'UTC')::date
+        UNION ALL
+        SELECT (clicked_at AT TIME ZONE 'UTC')::date, COALESCE(platform, ''),
+               COALESCE(country, ''), LEFT(COALESCE(referer, ''), 512), COUNT(*)
+        FROM raw
+        GROUP BY 1, 2, 3, 4
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM dynamic_links WHERE short_code = $1) AS link_exists,
+        (SELECT COALESCE(SUM(clicks), 0) FROM daily)::bigint AS total_clicks,
+        (SELECT COUNT(DISTINCT ip_address) FROM link_analytics
+         WHERE short_code = $1 AND clicked_at >= $2) AS unique_clicks,
+        (SELECT COALESCE(jsonb_agg(jsonb_build_array(platform, count)), '[]'::jsonb)
+         FROM (SELECT platform, SUM(clicks) AS count FROM daily
+               WHERE platform <> '' GROUP BY platform) s) AS platforms,
+        (SELECT COALESCE(jsonb_agg(jsonb_build_array(country, count) ORDER BY count DESC), '[]'::jsonb)
+         FROM (SELECT country, SUM(clicks) AS count FROM daily
+               WHERE country <> '' GROUP BY country ORDER BY count DESC LIMIT 10) s) AS countries,
+        (SELECT COALESCE(jsonb_agg(jsonb_build_array(day::text, count) ORDER BY day), '[]'::jsonb)
+         FROM (SELECT day, SUM(clicks) AS count FROM daily GROUP BY day) s) AS dates,
+        (SELECT COALESCE(jsonb_agg(jsonb_build_array(referer, count) ORDER BY count DESC), '[]'::jsonb)
+         FROM (SELECT referer, SUM(clicks) AS count FROM daily
+               WHERE referer <> '' GROUP BY referer ORDER BY count DESC LIMIT 10) s) AS referrers;
+"""
+
+
 @router.get(
     "/api/v1/analytics/{short_code}",
     response_model=LinkAnalyticsResponse,
@@ -262,70 +337,33 @@ async def get_link_analytics(
     db: PostgresDB = Depends(get_db_instance)
 ):
     """Get analytics for a specific dynamic link."""
-    
-    # Verify link exists
-    link_query = "SELECT 1 FROM dynamic_links WHERE short_code = $1;"
-    if not await db.fetchrow(link_query, short_code):
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Dynamic link not found"
-        )
 
     # Calculate date range
     end_date = datetime.now(timezone.utc)
     start_date = end_date - timedelta(days=days)
 
-    # Total clicks
-    total_clicks_query = "SELECT COUNT(*) FROM link_analytics WHERE short_code = $1 AND clicked_at >= $2;"
-    total_clicks_result = await db.fetchrow(total_clicks_query, short_code, start_date)
-    total_clicks = total_clicks_result['count'] if total_clicks_result else 0
-
-    # Unique clicks (based on hashed IP)
-    unique_clicks_query = "SELECT COUNT(DISTINCT ip_address) FROM link_analytics WHERE short_code = $1 AND clicked_at >= $2;"
-    unique_clicks_result = await db.fetchrow(unique_clicks_query, short_code, start_date)
-    unique_clicks = unique_clicks_result['count'] if unique_clicks_result else 0
-
-    # Clicks by platform
-    platform_stats_query = """
-        SELECT platform, COUNT(*) as count FROM link_analytics
-        WHERE short_code = $1 AND clicked_at >= $2 AND platform IS NOT NULL
-        GROUP BY platform;
-    """
-    platform_stats = await db.fetch(platform_stats_query, short_code, start_date)
-    clicks_by_platform = {row['platform']: row['count'] for row in platform_stats}
-
-    # Clicks by country
-    country_stats_query = """
-        SELECT country, COUNT(*) as count FROM link_analytics
-        WHERE short_code = $1 AND clicked_at >= $2 AND country IS NOT NULL
-        GROUP BY country ORDER BY count DESC LIMIT 10;
-    """
-    country_stats = await db.fetch(country_stats_query, short_code, start_date)
-    clicks_by_country = {row['country']: row['count'] for row in country_stats}
-
-    # Clicks by date
-    date_stats_query = """
-        SELECT DATE(clicked_at) as date, COUNT(*) as count FROM link_analytics
-        WHERE short_code = $1 AND clicked_at >= $2
-        GROUP BY DATE(clicked_at) ORDER BY date;
-    """
-    date_stats = await db.fetch(date_stats_query, short_code, start_date)
-    clicks_by_date = {str(row['date']): row['count'] for row in date_stats}
-
-    # Top referrers
-    referrer_stats_query = """
-        SELECT referer, COUNT(*) as count FROM link_analytics
-        WHERE short_code = $1 AND clicked_at >= $2 AND referer IS NOT NULL
-        GROUP BY referer ORDER BY count DESC LIMIT 10;
-    """
-    referrer_stats = await db.fetch(referrer_stats_query, short_code, start_date)
-    top_referrers = {row['referer']: row['count'] for row in referrer_stats}
-
-    return LinkAnalyticsResponse(
-        total_clicks=total_clicks,
-        unique_clicks=unique_clicks,
-        clicks_by_platform=clicks_by_platform,
-        clicks_by_country=clicks_by_country,
-        clicks_by_date=clicks_by_date,
-        top_referrers=top_referrers
-    )
\ No newline at end of file
+    # The rollup covers whole UTC days, from the first midnight after start_date up to
+    # at most the start of yesterday; raw rows cover the rest of the window.
+    rollup_from = (start_date + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    recent_since = (end_date - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # Every aggregate in one round trip; the CTE is materialized once and shared.
+    # Breakdowns come back as ordered [key, count] pairs so the top-N order survives jsonb.
+    # The link's existence is checked in the same query.
+    stats = await db.fetchrow(ANALYTICS_QUERY, short_code, start_date, rollup_from, recent_since)
+    if not stats['link_exists']:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Dynamic link not found"
+        )
+
+    # Returned as a response directly so FastAPI skips re-validating the trusted dict;
+    # response_model still documents the shape.
+    return ORJSONResponse({
+        "total_clicks": stats['total_clicks'],
+        "unique_clicks": stats['unique_clicks'],
+        "clicks_by_platform": dict(stats['platforms']),
+        "clicks_by_country": dict(stats['countries']),
+        "clicks_by_date": dict(stats['dates']),
+        "top_referrers": dict(stats['referrers']),
+    })
\ No newline at end of file
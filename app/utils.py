@@ -1,24 +1,42 @@
-import random
+import os
 import string
 import hashlib
+from functools import lru_cache
 from typing import Optional
 # from app.models import DynamicLink
 from app.db_pg import PostgresDB
 
 
+# Random bytes 0-247 map onto the 62-character alphabet exactly four times over;
+# 248-255 are dropped so every character stays equally likely.
+_ALPHABET = string.ascii_letters + string.digits
+_BYTE_TO_CHAR = (_ALPHABET * 5)[:256].encode()
+_REJECTED_BYTES = bytes(range(4 * len(_ALPHABET), 256))
+
+
 def generate_short_code(length: int = 7) -> str:
-    """Generate a random short code for the dynamic link."""
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
-
-
-async def generate_unique_short_code(db: PostgresDB, length: int = 7, max_attempts: int = 100) -> str:
-    """Generate a unique short code that doesn't exist in the database."""
-    for _ in range(max_attempts):
-        short_code = generate_short_code(length)
-        query = "SELECT 1 FROM dynamic_links WHERE short_code = $1;"
-        if not await db.fetchrow(query, short_code):
-            return short_code
+    """Generate a random short code for the dynamic link from the OS CSPRNG."""
+    code = b""
+    while len(code) < length:
+        code += os.urandom(length + 2).translate(_BYTE_TO_CHAR, _REJECTED_BYTES)
+    return code[:length].decode()
+
+
+async def generate_unique_short_code(
+    db: PostgresDB, length: int = 7, max_attempts: int = 100, batch_size: int = 8
+) -> str:
+    """Generate a unique short code that doesn't exist in the database.
+
+    Candidates are checked a batch at a time, so a single round trip is enough
+    unless every candidate in the batch is already taken.
+    """
+    query = "SELECT short_code FROM dynamic_links WHERE short_code = ANY($1::text[]);"
+    for _ in range(0, max_attempts, batch_size):
+        candidates = [generate_short_code(length) for _ in range(batch_size)]
+        taken = {code for (code,) in await db.fetch(query, candidates)}
+        for short_code in candidates:
+            if short_code not in taken:
+                return short_code
     raise Exception("Could not generate a unique short code.")
 
 
@@ -35,6 +53,7 @@ async def generate_custom_short_code(custom_code: str, db: PostgresDB) -> str:
     return custom_code
 
 
+@lru_cache(maxsize=65536)
 def hash_ip_address(ip_address: str, salt: str = "dynalinks_salt") -> str:
-    """Hash IP address for privacy compliance."""
-    return hashlib.sha256(ip_address.encode()).hexdigest()[:16]
+    """Hash IP address for privacy compliance, keyed with the salt. Repeat visitors hit the cache."""
+    return hashlib.blake2b(ip_address.encode(), digest_size=8, key=salt.encode()).hexdigest()
@@ -0,0 +1,26 @@
+-- Precomputed server-side redirect targets (GET /{short_code} for non-mobile clients).
+-- routing maps platform -> [url, redirect_type]; the trigger keeps it in sync on write,
+-- so the redirect does a single dict lookup instead of branching per request.
+ALTER TABLE dynamic_links ADD COLUMN IF NOT EXISTS routing JSONB;
+
+CREATE OR REPLACE FUNCTION dynamic_links_routing(desktop TEXT, fallback TEXT) RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+        'Desktop', CASE WHEN COALESCE(desktop, '') = '' THEN jsonb_build_array(fallback, 'fallback')
+                        ELSE jsonb_build_array(desktop, 'desktop') END,
+        'fallback', jsonb_build_array(fallback, 'fallback')
+    );
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION dynamic_links_set_routing() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.routing := dynamic_links_routing(NEW.desktop_url, NEW.fallback_url);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS dynamic_links_routing ON dynamic_links;
+CREATE TRIGGER dynamic_links_routing
+    BEFORE INSERT OR UPDATE OF desktop_url, fallback_url ON dynamic_links
+    FOR EACH ROW EXECUTE FUNCTION dynamic_links_set_routing();
+
+UPDATE dynamic_links SET routing = dynamic_links_routing(desktop_url, fallback_url) WHERE routing IS NULL;
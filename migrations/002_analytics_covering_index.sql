@@ -0,0 +1,10 @@
+-- Covering index for the analytics aggregates (GET /api/v1/analytics/{short_code}).
+-- Every aggregate filters on short_code = $1 AND clicked_at >= $2 and reads only
+-- ip_address, platform, country and referer, so they can run as index-only scans.
+-- It also serves plain short_code lookups, which makes the old single-column index redundant.
+-- CONCURRENTLY cannot run inside a transaction; apply with plain psql.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_link_analytics_short_code_clicked_at
+    ON link_analytics (short_code, clicked_at DESC)
+    INCLUDE (ip_address, platform, country, referer);
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_link_analytics_short_code;
@@ -0,0 +1,25 @@
+-- Daily click rollup for GET /api/v1/analytics/{short_code}.
+-- Breakdowns for closed days are summed from here instead of re-aggregating raw
+-- link_analytics rows. The API reads the days not rolled up yet from the raw table.
+-- Unique clicks cannot be summed across days without HLL, so they stay on the raw table.
+-- The app appends each UTC day once it has closed (app/analytics_rollup.py); its first
+-- run backfills every closed day already in link_analytics.
+-- NULL dimensions are stored as '' so they can be part of the primary key.
+DROP MATERIALIZED VIEW IF EXISTS link_analytics_daily;
+
+CREATE TABLE IF NOT EXISTS link_analytics_daily (
+    short_code VARCHAR(10) NOT NULL,
+    day DATE NOT NULL,
+    platform VARCHAR(50) NOT NULL,
+    country VARCHAR(2) NOT NULL,
+    referer VARCHAR(512) NOT NULL,
+    clicks BIGINT NOT NULL,
+    PRIMARY KEY (short_code, day, platform, country, referer)
+);
+
+-- Serves MAX(day), the rollup's high-water mark
+CREATE INDEX IF NOT EXISTS idx_link_analytics_daily_day ON link_analytics_daily (day);
+
+-- Lets the rollup read one day of raw rows without scanning the whole table;
+-- BRIN stays tiny because clicks are appended in clicked_at order.
+CREATE INDEX IF NOT EXISTS idx_link_analytics_clicked_at ON link_analytics USING brin (clicked_at);
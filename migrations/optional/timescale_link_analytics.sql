@@ -0,0 +1,28 @@
+-- OPTIONAL: store link_analytics as a TimescaleDB hypertable with columnar compression.
+-- Requires a server with the timescaledb extension (e.g. the timescale/timescaledb-ha
+-- image instead of postgres:latest). Apply after the numbered migrations; the
+-- application queries are unchanged.
+--
+-- Click rows are append-only and the analytics endpoint aggregates a handful of
+-- columns over a time range. Chunks older than 7 days are compressed column by
+-- column and segmented by short_code, so those aggregates read only the columns
+-- they touch.
+CREATE EXTENSION IF NOT EXISTS timescaledb;
+
+-- Unique constraints on a hypertable must include the partitioning column
+ALTER TABLE link_analytics DROP CONSTRAINT IF EXISTS link_analytics_pkey;
+ALTER TABLE link_analytics ADD PRIMARY KEY (id, clicked_at);
+
+SELECT create_hypertable(
+    'link_analytics', 'clicked_at',
+    chunk_time_interval => INTERVAL '1 day',
+    migrate_data => true
+);
+
+ALTER TABLE link_analytics SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'short_code',
+    timescaledb.compress_orderby = 'clicked_at DESC'
+);
+
+SELECT add_compression_policy('link_analytics', INTERVAL '7 days');
@@ -16,9 +16,30 @@ CREATE TABLE dynamic_links (
     creator_id VARCHAR(255),
     created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
     updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-    custom_parameters JSONB
+    custom_parameters JSONB,
+    routing JSONB
 );
 
+-- routing maps platform -> [url, redirect_type] for server-side redirects; kept in sync by trigger
+CREATE FUNCTION dynamic_links_routing(desktop TEXT, fallback TEXT) RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+        'Desktop', CASE WHEN COALESCE(desktop, '') = '' THEN jsonb_build_array(fallback, 'fallback')
+                        ELSE jsonb_build_array(desktop, 'desktop') END,
+        'fallback', jsonb_build_array(fallback, 'fallback')
+    );
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE FUNCTION dynamic_links_set_routing() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.routing := dynamic_links_routing(NEW.desktop_url, NEW.fallback_url);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER dynamic_links_routing
+    BEFORE INSERT OR UPDATE OF desktop_url, fallback_url ON dynamic_links
+    FOR EACH ROW EXECUTE FUNCTION dynamic_links_set_routing();
+
 CREATE TABLE link_analytics (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     link_id UUID NOT NULL,
@@ -41,4 +62,19 @@ CREATE TABLE link_analytics (
 
 CREATE INDEX idx_dynamic_links_short_code ON dynamic_links(short_code);
 CREATE INDEX idx_link_analytics_link_id ON link_analytics(link_id);
-CREATE INDEX idx_link_analytics_short_code ON link_analytics(short_code);
+CREATE INDEX idx_link_analytics_short_code_clicked_at ON link_analytics (short_code, clicked_at DESC)
+    INCLUDE (ip_address, platform, country, referer);
+CREATE INDEX idx_link_analytics_clicked_at ON link_analytics USING brin (clicked_at);
+
+-- Daily click rollup, appended by the app as days close (see migrations/003_analytics_daily_rollup.sql)
+CREATE TABLE link_analytics_daily (
+    short_code VARCHAR(10) NOT NULL,
+    day DATE NOT NULL,
+    platform VARCHAR(50) NOT NULL,
+    country VARCHAR(2) NOT NULL,
+    referer VARCHAR(512) NOT NULL,
+    clicks BIGINT NOT NULL,
+    PRIMARY KEY (short_code, day, platform, country, referer)
+);
+
+CREATE INDEX idx_link_analytics_daily_day ON link_analytics_daily (day);
@@ -0,0 +1,100 @@
+import pytest
+from httpx import AsyncClient, ASGITransport
+from app.main import app
+from app.db_pg import get_db_instance, PostgresDB
+from datetime import datetime, timezone
+
+# Mock database for testing
+class MockPostgresDB(PostgresDB):
+    _data = {}
+
+    def __init__(self):
+        # Override the __init__ to prevent it from trying to build a DSN
+        self.pool = None
+
+    async def connect(self):
+        # Mock connection
+        self._data = {}
+
+    async def disconnect(self):
+        # Mock disconnection
+        self._data = {}
+
+    async def fetch(self, query, *args):
+        if "SELECT * FROM dynamic_links" in query:
+            return list(self._data.values())
+        return []
+
+    async def fetchrow(self, query, *args):
+        # Dispatch on the statement's first keyword
+        handler = self._fetchrow_handlers.get(query.split(None, 1)[0])
+        return handler(self, query, *args) if handler else None
+
+    def _select(self, query, *args):
+        if "WHERE short_code = $1" in query:
+            return self._data.get(args[0])
+        return None
+
+    def _insert(self, query, *args):
+        short_code = args[0]
+        link_data = {
+            "id": "a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11",
+            "short_code": short_code,
+            "short_url": f"http://test/{short_code}",
+            "fallback_url": str(args[3]).rstrip('/'),
+            "is_active": True,
+            "expires_at": None,
+            "created_at": datetime.now(timezone.utc),
+            "updated_at": datetime.now(timezone.utc)
+        }
+        self._data[short_code] = link_data
+        return link_data
+
+    def _update(self, query, *args):
+        link = self._data.get(args[-1])
+        if link is not None and "is_active = FALSE" in query:
+            link['is_active'] = False
+        return link
+
+    _fetchrow_handlers = {"SELECT": _select, "INSERT": _insert, "UPDATE": _update}
+
+    async def fetch_link(self, short_code):
+        link = self._data.get(short_code)
+        return link if link and link['is_active'] else None
+
+    async def execute(self, query, *args):
+        pass
+
+    async def insert_clicks(self, rows):
+        pass
+
+
+# Create a single mock db instance to be used by the app and tests
+_mock_db = MockPostgresDB()
+
+# Override the get_db_instance dependency
+async def override_get_db_instance():
+    return _mock_db
+
+app.dependency_overrides[get_db_instance] = override_get_db_instance
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+async def client():
+    # One client for the whole session; the app's lifespan is not run, so no real
+    # database or Redis connections are opened.
+    await _mock_db.connect()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
+        yield c
+
+@pytest.fixture(autouse=True)
+def reset_mock_db():
+    # Isolate tests from each other's links without reconnecting
+    _mock_db._data.clear()
+
+@pytest.fixture
+def mock_db():
+    return _mock_db
@@ -1,83 +1,21 @@
 import pytest
-from httpx import AsyncClient, ASGITransport
-from app.main import app
-from app.db_pg import get_db_instance, PostgresDB
+from httpx import AsyncClient
+from app.routers.redirect import generate_redirect_html
+from app import middleware
+from app.middleware import client_address, local_request_counts, _local_rate_limited
 from app.config import settings
-from datetime import datetime, timezone
-
-# Mock database for testing
-class MockPostgresDB(PostgresDB):
-    _data = {}
-
-    def __init__(self):
-        # Override the __init__ to prevent it from trying to build a DSN
-        self.pool = None
-
-    async def connect(self):
-        # Mock connection
-        self._data = {}
-
-    async def disconnect(self):
-        # Mock disconnection
-        self._data = {}
-
-    async def fetch(self, query, *args):
-        if "SELECT * FROM dynamic_links" in query:
-            return list(self._data.values())
-        return []
-
-    async def fetchrow(self, query, *args):
-        s_query = query.strip()
-
-        if s_query.startswith("SELECT") and "WHERE short_code = $1" in s_query:
-            return self._data.get(args[0])
-
-        if s_query.startswith("INSERT"):
-            short_code = args[0]
-            link_data = {
-                "id": "a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11",
-                "short_code": short_code,
-                "short_url": f"http://test/{short_code}",
-                "fallback_url": str(args[3]).rstrip('/'),
-                "is_active": True,
-                "created_at": datetime.now(timezone.utc),
-                "updated_at": datetime.now(timezone.utc)
-            }
-            self._data[short_code] = link_data
-            return link_data
-
-        if s_query.startswith("UPDATE"):
-            short_code = args[-1]
-            if short_code in self._data:
-                if "is_active = FALSE" in s_query:
-                    self._data[short_code]['is_active'] = False
-                return self._data[short_code]
-
-        return None
-
-    async def execute(self, query, *args):
-        pass
-
-
-# Create a single mock db instance to be used by the app and tests
-mock_db = MockPostgresDB()
-
-# Override the get_db_instance dependency
-async def override_get_db_instance():
-    return mock_db
-
-app.dependency_overrides[get_db_instance] = override_get_db_instance
-
-@pytest.fixture(scope="module")
-def anyio_backend():
-    return "asyncio"
-
-@pytest.fixture(scope="module")
-async def client():
-    # Reset mock db for each test module
-    await mock_db.connect()
-    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
-        yield c
+import asyncio
+import orjson
+import ipaddress
+from collections import Counter
+from contextlib import asynccontextmanager
+from app.analytics_rollup import ROLL_UP_CLOSED_DAYS, roll_up_closed_days
+from app.analytics_writer import AnalyticsWriter
+from app.utils import _ALPHABET, generate_short_code, generate_unique_short_code
+from app.analytics import (
+    build_redirect_url, build_redirect_url_cached, detect_platform_and_device, freeze_parameters, get_client_ip,
+)
+from datetime import datetime, timedelta, timezone
 
 @pytest.mark.anyio
 async def test_create_link(client: AsyncClient):
@@ -103,7 +41,24 @@ async def test_create_and_get_link(client: AsyncClient):
     assert get_data["short_code"] == short_code
 
 @pytest.mark.anyio
-async def test_delete_link(client: AsyncClient):
+async def test_get_link_cache_hit_returns_cached_body(client: AsyncClient, monkeypatch):
+    from app.cache import cache
+    from app.routers.links import _cache_entry
+
+    body = b'{"short_code":"testhit","fallback_url":"https://hit-example.com"}'
+
+    async def cached_entry(key):
+        return _cache_entry("a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11", body) if key == "link:testhit" else None
+
+    monkeypatch.setattr(cache, "get_bytes", cached_entry)
+    response = await client.get("/api/v1/links/testhit")
+    assert response.status_code == 200
+    assert response.headers["x-cache"] == "HIT"
+    assert response.content == body
+
+
+@pytest.mark.anyio
+async def test_delete_link(client: AsyncClient, mock_db):
     # Create a link
     create_response = await client.post("/api/v1/links/?custom_code=testdelete", json={"fallback_url": "https://delete-example.com"})
     assert create_response.status_code == 200
@@ -117,14 +72,439 @@ async def test_delete_link(client: AsyncClient):
     # Verify it's inactive (by trying to get it, assuming get only returns active)
     # The current get implementation does not check for active status, so this will pass.
     # To properly test, the get logic should be updated or we check the mock db state.
-    db = await override_get_db_instance()
-    link = await db.fetchrow("SELECT * FROM dynamic_links WHERE short_code = $1", short_code)
+    link = await mock_db.fetchrow("SELECT * FROM dynamic_links WHERE short_code = $1", short_code)
     assert link is not None
     assert not link['is_active']
 
 
+@pytest.mark.anyio
+async def test_update_link(client: AsyncClient):
+    create_response = await client.post("/api/v1/links/?custom_code=testupdate", json={"fallback_url": "https://update-example.com"})
+    assert create_response.status_code == 200
+
+    update_response = await client.put("/api/v1/links/testupdate", json={"title": "Updated", "desktop_url": "https://desktop.example.com"})
+    assert update_response.status_code == 200
+    assert update_response.json()["short_code"] == "testupdate"
+
+    missing_response = await client.put("/api/v1/links/nosuchcode", json={"title": "Updated"})
+    assert missing_response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_redirect_desktop_to_fallback(client: AsyncClient):
+    await client.post("/api/v1/links/?custom_code=testredir", json={"fallback_url": "https://redirect-example.com"})
+
+    desktop_ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+    response = await client.get("/testredir", headers={"User-Agent": desktop_ua})
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://redirect-example.com"
+    assert response.headers["cache-control"] == "no-store"
+
+    missing = await client.get("/nosuchcode", headers={"User-Agent": desktop_ua})
+    assert missing.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_redirect_expired_link_is_gone(client: AsyncClient, mock_db):
+    await client.post("/api/v1/links/?custom_code=testexp", json={"fallback_url": "https://expired-example.com"})
+    mock_db._data["testexp"]["expires_at"] = datetime.now(timezone.utc) - timedelta(minutes=1)
+
+    response = await client.get("/testexp")
+    assert response.status_code == 410
+
+
+@pytest.mark.anyio
+async def test_redirect_mobile_serves_html(client: AsyncClient, mock_db):
+    await client.post("/api/v1/links/?custom_code=testmobile", json={"fallback_url": "https://mobile-example.com"})
+    mock_db._data["testmobile"].update(ios_url="myapp://ios", android_url="myapp://android")
+
+    iphone_ua = "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148"
+    response = await client.get("/testmobile", headers={"User-Agent": iphone_ua})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/html")
+    assert response.headers["cache-control"] == "no-store"
+    assert 'href="https://mobile-example.com"' in response.text
+    assert 'var deepLink = "myapp://ios";' in response.text
+
+    android_ua = "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 Chrome/120.0 Mobile Safari/537.36"
+    response = await client.get("/testmobile?tag=x", headers={"User-Agent": android_ua})
+    assert 'var deepLink = "myapp://android?tag=x";' in response.text
+    assert "myapp://ios" not in response.text
+
+
+@pytest.mark.anyio
+async def test_redirect_serves_cached_link_and_page(client: AsyncClient, monkeypatch):
+    from app.cache import cache
+
+    link = {
+        "id": "a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11",
+        "fallback_url": "https://cached-example.com",
+        "ios_url": "myapp://cached",
+        "routing": {"fallback": ["https://cached-example.com", "fallback"]},
+        "_exp_ts": 0,
+    }
+    entries = {"redirect:testcached": orjson.dumps(link), "html:testcached:ios": b"<html>cached page</html>"}
+    requested = []
+
+    async def mget(*keys):
+        requested.append(keys)
+        return [entries.get(key) for key in keys]
+
+    monkeypatch.setattr(cache, "mget", mget)
+
+    # Nothing in the mock database: both responses come from the cache alone
+    iphone_ua = "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148"
+    response = await client.get("/testcached", headers={"User-Agent": iphone_ua})
+    assert response.status_code == 200
+    assert response.content == b"<html>cached page</html>"
+    assert requested[-1] == ("redirect:testcached", "html:testcached:ios")
+
+    response = await client.get("/testcached")
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://cached-example.com"
+    assert requested[-1] == ("redirect:testcached",)
+
+
+@pytest.mark.anyio
+async def test_redirect_drops_unreadable_cache_entry(client: AsyncClient, monkeypatch):
+    from app.cache import cache
+
+    await client.post("/api/v1/links/?custom_code=testbad", json={"fallback_url": "https://bad-example.com"})
+    deleted = []
+
+    async def mget(*keys):
+        return [b"{not json" if key == "redirect:testbad" else None for key in keys]
+
+    async def delete(*keys):
+        deleted.extend(keys)
+        return True
+
+    monkeypatch.setattr(cache, "mget", mget)
+    monkeypatch.setattr(cache, "delete", delete)
+
+    response = await client.get("/testbad")
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://bad-example.com"
+    assert deleted == ["redirect:testbad"]
+
+
+@pytest.mark.anyio
+async def test_analytics_counts_partial_first_day_from_raw_rows(client: AsyncClient, mock_db, monkeypatch):
+    await client.post("/api/v1/links/?custom_code=teststats", json={"fallback_url": "https://stats-example.com"})
+
+    # ANALYTICS_QUERY itself needs Postgres; the stub below only checks that the endpoint's
+    # rollup_from/recent_since arithmetic splits the window without gaps or double counts,
+    # assuming the rollup has caught up to recent_since.
+    # One click every hour for ten days, alternating platforms; the half-hour offset keeps
+    # clicks clear of the window edges, which shift slightly with the endpoint's own now()
+    now = datetime.now(timezone.utc)
+    clicks = [(now - timedelta(hours=h, minutes=30), "iOS" if h % 2 else "Android") for h in range(240)]
+    # What link_analytics_daily holds once those days are rolled up
+    rollup = Counter(((clicked_at.date(), platform) for clicked_at, platform in clicks))
+
+    async def fetchrow(query, short_code, start_date, rollup_from, recent_since):
+        # Emulates ANALYTICS_QUERY: rollup days in [rollup_from, recent_since), raw rows elsewhere
+        daily = Counter()
+        for (day, platform), count in rollup.items():
+            if rollup_from.date() <= day < recent_since.date():
+                daily[platform] += count
+        for clicked_at, platform in clicks:
+            if start_date <= clicked_at < min(rollup_from, recent_since) or clicked_at >= max(start_date, recent_since):
+                daily[platform] += 1
+        return {
+            "link_exists": True,
+            "total_clicks": sum(daily.values()),
+            "unique_clicks": 0,
+            "platforms": list(daily.items()),
+            "countries": [],
+            "dates": [],
+            "referrers": [],
+        }
+
+    monkeypatch.setattr(mock_db, "fetchrow", fetchrow)
+    response = await client.get("/api/v1/analytics/teststats?days=5")
+    assert response.status_code == 200
+
+    # Matches an exact clicked_at >= start_date count, even though start_date falls mid-day
+    start_date = now - timedelta(days=5)
+    expected = sum(1 for clicked_at, _ in clicks if clicked_at >= start_date)
+    data = response.json()
+    assert data["total_clicks"] == expected
+    assert sum(data["clicks_by_platform"].values()) == expected
+
+
+def test_generate_redirect_html_escapes_values():
+    html = generate_redirect_html(
+        deep_link="myapp://open?x='1'",
+        fallback_url="https://example.com/?a=1&b=2",
+        social_title='<script>alert("x")</script>',
+    )
+    assert "<script>alert" not in html
+    assert "&lt;script&gt;" in html
+    assert 'deepLink = "myapp://open?x=\'1\'";' in html
+    assert 'href="https://example.com/?a=1&amp;b=2"' in html
+
+
 @pytest.mark.anyio
 async def test_health_check(client: AsyncClient):
     response = await client.get("/api/v1/health")
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
+    assert int(response.headers["x-process-time-us"]) >= 0
+
+@pytest.mark.anyio
+async def test_list_links(client: AsyncClient):
+    await client.post("/api/v1/links/?custom_code=testlist", json={"fallback_url": "https://list-example.com"})
+
+    response = await client.get("/api/v1/links/")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    short_codes = [link["short_code"] for link in response.json()]
+    assert "testlist" in short_codes
+
+
+def test_detect_platform_and_device_is_cached():
+    iphone_ua = (
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 "
+        "(KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1"
+    )
+    first = detect_platform_and_device(iphone_ua)
+    assert first[0] == "iOS"
+    assert first[1] == "Mobile"
+    assert detect_platform_and_device(iphone_ua) is first
+    # Padding past the 500 stored characters shares the same cache entry
+    long_ua = iphone_ua.ljust(500, "x")
+    assert detect_platform_and_device(long_ua + "y" * 4096) is detect_platform_and_device(long_ua)
+
+
+def test_get_client_ip_prefers_first_forwarded_address():
+    class _Client:
+        host = "10.0.0.1"
+
+    class _Request:
+        def __init__(self, headers):
+            self.headers = headers
+            self.client = _Client()
+
+    assert get_client_ip(_Request({"x-forwarded-for": " 203.0.113.7 , 10.0.0.2"})) == "203.0.113.7"
+    assert get_client_ip(_Request({"x-forwarded-for": "198.51.100.1"})) == "198.51.100.1"
+    assert get_client_ip(_Request({"x-real-ip": "192.0.2.5"})) == "192.0.2.5"
+    assert get_client_ip(_Request({})) == "10.0.0.1"
+    assert get_client_ip(_Request({"x-forwarded-for": "2001:DB8::0001"})) == "2001:db8::1"
+    # Malformed or oversized values never reach the per-IP caches
+    assert get_client_ip(_Request({"x-forwarded-for": "not-an-ip", "x-real-ip": "192.0.2.5"})) == "192.0.2.5"
+    assert get_client_ip(_Request({"x-forwarded-for": "1" * 4096})) == "10.0.0.1"
+
+
+def test_local_rate_limit_fallback(monkeypatch):
+    monkeypatch.setattr(settings, "rate_limit_per_minute", 2)
+    local_request_counts.pop("198.51.100.9", None)
+
+    assert not _local_rate_limited("198.51.100.9")
+    assert not _local_rate_limited("198.51.100.9")
+    assert _local_rate_limited("198.51.100.9")
+
+
+def test_client_address_trusts_only_configured_proxies(monkeypatch):
+    def scope(peer, forwarded=None):
+        headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+        return {"client": (peer, 443), "headers": headers}
+
+    monkeypatch.setattr(middleware, "_TRUSTED_PROXIES", ())
+    assert client_address(scope("10.1.2.3", "203.0.113.7")) == "10.1.2.3"
+
+    monkeypatch.setattr(middleware, "_TRUSTED_PROXIES", (ipaddress.ip_network("10.0.0.0/8"),))
+    assert client_address(scope("10.1.2.3", "203.0.113.7")) == "203.0.113.7"
+    # The right-most untrusted hop wins; a spoofed left-most entry is ignored
+    assert client_address(scope("10.1.2.3", "198.51.100.66, 203.0.113.7, 10.4.4.4")) == "203.0.113.7"
+    assert client_address(scope("192.0.2.1", "203.0.113.7")) == "192.0.2.1"
+    assert client_address(scope("10.1.2.3", "garbage")) == "10.1.2.3"
+    assert client_address(scope("10.1.2.3")) == "10.1.2.3"
+
+
+@pytest.mark.anyio
+async def test_rate_limit_counts_forwarded_clients_in_redis(client: AsyncClient, monkeypatch):
+    from app.cache import cache
+
+    counts = Counter()
+
+    async def increment_window(key, window_seconds):
+        counts[key] += 1
+        return counts[key]
+
+    monkeypatch.setattr(cache, "increment_window", increment_window)
+    monkeypatch.setattr(settings, "rate_limit_per_minute", 2)
+    monkeypatch.setattr(middleware, "_TRUSTED_PROXIES", (ipaddress.ip_network("127.0.0.0/8"),))
+
+    for _ in range(2):
+        assert (await client.get("/api/v1/health", headers={"x-forwarded-for": "203.0.113.7"})).status_code == 200
+    limited = await client.get("/api/v1/health", headers={"x-forwarded-for": "203.0.113.7"})
+    assert limited.status_code == 429
+    assert limited.headers["retry-after"] == "60"
+    # Another client behind the same proxy has its own window
+    assert (await client.get("/api/v1/health", headers={"x-forwarded-for": "198.51.100.9"})).status_code == 200
+    assert sorted(key.rsplit(":", 1)[0] for key in counts) == ["rl:198.51.100.9", "rl:203.0.113.7"]
+
+
+def test_build_redirect_url_encodes_parameters():
+    assert build_redirect_url("https://example.com") == "https://example.com"
+    assert build_redirect_url("https://example.com", {"a": None}) == "https://example.com"
+    assert build_redirect_url("https://example.com", {"q": "a b&c", "n": 1}) == "https://example.com?q=a+b%26c&n=1"
+    assert build_redirect_url("https://example.com/?x=1", {"tag": ["a", "b"]}) == "https://example.com/?x=1&tag=a&tag=b"
+
+    params = {"q": "a b&c", "tag": ["a", "b"]}
+    assert build_redirect_url_cached("https://example.com", freeze_parameters(params)) == \
+        build_redirect_url("https://example.com", params)
+    assert build_redirect_url_cached("https://example.com", freeze_parameters({})) == "https://example.com"
+
+
+@pytest.mark.anyio
+async def test_generate_qr_code(client: AsyncClient):
+    await client.post("/api/v1/links/?custom_code=testqr", json={"fallback_url": "https://qr-example.com"})
+
+    response = await client.get("/api/v1/links/testqr/qr?size=200&border=4")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert response.content.startswith(b"\x89PNG")
+
+
+class RecordingDB:
+    """Stands in for PostgresDB in analytics writer tests, recording each batch."""
+
+    def __init__(self):
+        self.batches = []
+
+    async def insert_clicks(self, rows):
+        self.batches.append(list(rows))
+
+
+def _click(n):
+    return ("a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11", f"code{n}")
+
+
+@pytest.mark.anyio
+async def test_analytics_writer_flushes_full_batches_and_drains_on_stop():
+    db = RecordingDB()
+    writer = AnalyticsWriter(batch_size=3, flush_interval=10)
+    await writer.start(db)
+    for n in range(7):
+        writer.submit(_click(n))
+    await asyncio.sleep(0.01)
+    assert db.batches == [[_click(0), _click(1), _click(2)], [_click(3), _click(4), _click(5)]]
+
+    # The partial batch is still waiting on the interval; stop writes it out
+    await writer.stop()
+    assert db.batches[-1] == [_click(6)]
+
+
+@pytest.mark.anyio
+async def test_analytics_writer_flushes_after_interval():
+    db = RecordingDB()
+    writer = AnalyticsWriter(batch_size=100, flush_interval=0.01)
+    await writer.start(db)
+    writer.submit(_click(0))
+    writer.submit(_click(1))
+    await asyncio.sleep(0.05)
+    assert db.batches == [[_click(0), _click(1)]]
+    await writer.stop()
+    assert len(db.batches) == 1
+
+
+@pytest.mark.anyio
+async def test_analytics_writer_drops_clicks_when_queue_is_full(caplog):
+    db = RecordingDB()
+    writer = AnalyticsWriter(max_queued=2)
+    for n in range(3):
+        writer.submit(_click(n))
+    assert "dropping click for short code: code2" in caplog.text
+
+    await writer.start(db)
+    await writer.stop()
+    assert [row for batch in db.batches for row in batch] == [_click(0), _click(1)]
+
+
+class _RollupDB:
+    """Stands in for PostgresDB; the advisory lock lives until the transaction ends."""
+
+    def __init__(self, lock_held_elsewhere=False):
+        self.lock_held_elsewhere = lock_held_elsewhere
+        self.lock_held = False
+        self.checked_out = 0
+        self.executed = []
+        self.pool = self
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.checked_out += 1
+        try:
+            yield self
+        finally:
+            self.checked_out -= 1
+
+    @asynccontextmanager
+    async def transaction(self):
+        try:
+            yield
+        finally:
+            self.lock_held = False
+
+    async def fetchval(self, query, *args):
+        assert "pg_try_advisory_xact_lock" in query
+        self.lock_held = not self.lock_held_elsewhere
+        return self.lock_held
+
+    async def execute(self, query, *args):
+        assert self.lock_held
+        self.executed.append(query)
+
+
+@pytest.mark.anyio
+async def test_daily_rollup_holds_no_connection_or_lock_between_runs():
+    db = _RollupDB()
+    assert await roll_up_closed_days(db)
+    assert await roll_up_closed_days(db)
+    assert db.executed == [ROLL_UP_CLOSED_DAYS, ROLL_UP_CLOSED_DAYS]
+    assert not db.lock_held and db.checked_out == 0
+
+    busy = _RollupDB(lock_held_elsewhere=True)
+    assert not await roll_up_closed_days(busy)
+    assert busy.executed == [] and busy.checked_out == 0
+
+
+def test_generate_short_code_length_and_alphabet():
+    for length in (1, 7, 12, 64):
+        codes = [generate_short_code(length) for _ in range(200)]
+        assert all(len(code) == length for code in codes)
+        assert set("".join(codes)) <= set(_ALPHABET)
+    assert len(generate_short_code()) == 7
+
+
+class _TakenCodesDB:
+    """Stub for the batched ANY($1) lookup: reports the first `taken` candidates of each batch as used."""
+
+    def __init__(self, taken):
+        self.taken = taken
+        self.batches = []
+
+    async def fetch(self, query, candidates):
+        assert "= ANY($1::text[])" in query
+        self.batches.append(candidates)
+        return [(code,) for code in candidates[:self.taken]]
+
+
+@pytest.mark.anyio
+async def test_generate_unique_short_code_skips_taken_candidates():
+    db = _TakenCodesDB(taken=3)
+    short_code = await generate_unique_short_code(db, batch_size=8)
+    assert len(db.batches) == 1
+    assert len(db.batches[0]) == 8
+    assert short_code == db.batches[0][3]
+
+
+@pytest.mark.anyio
+async def test_generate_unique_short_code_gives_up_when_every_batch_is_taken():
+    db = _TakenCodesDB(taken=8)
+    with pytest.raises(Exception, match="Could not generate a unique short code"):
+        await generate_unique_short_code(db, max_attempts=20, batch_size=8)
+    assert len(db.batches) == 3
+